@@ -24,14 +24,27 @@ This file is MIT licensed and maintained at https://github.com/mgiraldo/tenprint
 from __future__ import division
 
 import argparse
+import collections
 import itertools
 import json
 import math
 import os
+import shutil
+import signal
 import sys
+import time
 
 import cairocffi as cairo
 
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+# The Linux ioctl request to clone the extents of a file into another file,
+# from <linux/fs.h>.
+_FICLONE = 0x40049409
+
 
 #
 # Private helper functions.
@@ -592,6 +605,152 @@ def draw(title, subtitle, author, cover_width=400, cover_height=600):
     return cover_image
 
 
+#
+# A minimal sampling profiler to find out where batch runs spend their time.
+# It uses a profiling interval timer and collects the Python stack of every
+# sample, which keeps the overhead low enough to run on production batches.
+#
+
+class Profiler(object):
+    """
+    The Profiler class samples the call stack in regular intervals using the
+    SIGPROF signal, and aggregates identical stacks. Because Python runs signal
+    handlers only between byte codes, several timer ticks during a long call
+    into Cairo (e.g. PNG encoding) arrive as a single signal; each sample is
+    therefore weighted by the CPU time elapsed since the previous one.
+
+    Frames are labeled with their function name (and class for methods); some
+    frames of the cover drawing code are further qualified by the data they
+    work on, e.g. the PETSCII glyph for drawShape() or the grid size for
+    drawArtwork(), so that the time can be related to the characteristics of
+    a title.
+
+    The collected samples can be written in the collapsed stack format used
+    by flamegraph.pl and many other tools, or as a speedscope JSON file:
+
+      https://github.com/brendangregg/FlameGraph
+      https://www.speedscope.app/
+    """
+
+    def __init__(self, interval=0.001):
+        """
+        Constructor. The interval is the sampling period in seconds of CPU time.
+        """
+        self.interval = interval
+        self.stacks = {}
+        self._handler = None
+        self._running = False
+        self._clock = getattr(time, "process_time", None) or time.clock
+        self._last = self._clock()
+
+
+    def start(self):
+        """
+        Install the signal handler and start sampling. Requires a platform that
+        supports signal.setitimer(), i.e. not Windows.
+        """
+        self._handler = signal.signal(signal.SIGPROF, self._sample)
+        self._running = True
+        self._last = self._clock()
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+
+    def stop(self):
+        """
+        Stop sampling and restore the previous signal handler.
+        """
+        if not self._running:
+            return
+        self._running = False
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._handler or signal.SIG_DFL)
+
+
+    @staticmethod
+    def _label(frame):
+        """
+        Return a descriptive name for the given stack frame.
+        """
+        code = frame.f_code
+        name = code.co_name
+        # Before Python 3.13 accessing f_locals copies all local variables of
+        # the frame, so do that only for frames that need them.
+        if code.co_varnames[:1] == ("self",):
+            f_locals = frame.f_locals
+            if "self" in f_locals:
+                name = type(f_locals["self"]).__name__ + "." + name
+        elif name == "drawShape":
+            f_locals = frame.f_locals
+            if "c" in f_locals:
+                name += " '" + f_locals["c"] + "'"
+        elif name == "drawArtwork":
+            f_locals = frame.f_locals
+            if "grid_count" in f_locals:
+                name += " {0}x{0}".format(f_locals["grid_count"])
+        elif name == "chop":
+            f_locals = frame.f_locals
+            if "word" in f_locals:
+                name += " {0} chars".format(len(f_locals["word"]))
+        return "{0} ({1}:{2})".format(name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+    def _sample(self, _, frame):
+        """
+        Signal handler: record the current call stack, outermost frame first,
+        and add the CPU time in seconds since the previous sample to it.
+        """
+        now = self._clock()
+        elapsed, self._last = now - self._last, now
+        stack = []
+        while frame is not None:
+            stack.append(self._label(frame))
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        self.stacks[stack] = self.stacks.get(stack, 0) + elapsed
+
+
+    def write_collapsed(self, f):
+        """
+        Write the samples in collapsed stack format, one line per unique stack
+        with its CPU time in microseconds. The format separates frames with a
+        semicolon, so semicolons in labels (e.g. the glyph of drawShape) are
+        written as U+003B.
+        """
+        for stack, elapsed in sorted(self.stacks.items()):
+            labels = [label.replace(";", "U+003B") for label in stack]
+            f.write(";".join(labels) + " " + str(int(round(elapsed * 1e6))) + "\n")
+
+
+    def write_speedscope(self, f):
+        """
+        Write the samples as a speedscope sampled profile in JSON format.
+        """
+        frames = []
+        indexes = {}
+        samples = []
+        weights = []
+        for stack, elapsed in sorted(self.stacks.items()):
+            for label in stack:
+                if label not in indexes:
+                    indexes[label] = len(frames)
+                    frames.append({"name": label})
+            samples.append([indexes[label] for label in stack])
+            weights.append(elapsed)
+        json.dump({
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": "tenprintcover",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }, f)
+
+
 #
 # The main function allows to run the cover generation to run as a standalone
 # command-line tool. Arguments can be passed, use -h or --help to get a list
@@ -604,25 +763,80 @@ def main():
     image generation.
     """
     # Helper function.
-    def _draw_and_save(title, subtitle, author, filename):
+    def _check_ext(filename):
         """
-        Draw a cover and write it to a file. Note that only PNG is supported.
+        Return True if the filename has a PNG extension, or print an error and
+        return False otherwise. Note that only PNG is supported.
+        """
+        _, ext = os.path.splitext(os.path.basename(filename))
+        if ext.upper() != ".PNG":
+            print("Unsupported image file format '" + ext + "', use PNG")
+            return False
+        return True
+
+    # Helper function.
+    def _save(cover_image, filename):
+        """
+        Write a cover image to a file. Note that only PNG is supported.
         """
-        cover_image = draw(title, subtitle, author)
         if filename == "-":
             assert not "Implement."
-        else:
-            _, ext = os.path.splitext(os.path.basename(filename))
-            if ext.upper() == ".PNG":
+        elif not _check_ext(filename):
+            return 1
+        try:
+            # Remove an existing file first instead of truncating it, because
+            # it may be hard linked to other covers from an earlier batch.
+            if os.path.lexists(filename):
+                os.remove(filename)
+            with open(filename, "wb") as f:
+                cover_image.save(f)
+        except (OSError, IOError):
+            print("Error opening target file " + filename)
+            return 1
+        return 0
+
+    # Helper function.
+    def _draw_and_save(title, subtitle, author, filename):
+        """
+        Draw a cover and write it to a file. Note that only PNG is supported.
+        """
+        return _save(draw(title, subtitle, author), filename)
+
+    # Helper function.
+    def _reflink(source, filename):
+        """
+        Create filename as a copy-on-write clone of source. Works only on Linux
+        file systems that support it (e.g. Btrfs, XFS), raises OSError/IOError
+        otherwise.
+        """
+        if fcntl is None:
+            raise OSError("Reflinks are not supported on this platform")
+        with open(source, "rb") as src:
+            with open(filename, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+
+    # Helper function.
+    def _link_or_copy(source, filename):
+        """
+        Make filename a copy of the already written cover file source. Depending
+        on what the target file system supports, create a hard link, else a
+        reflink, else fall back to copying the bytes.
+        """
+        if not _check_ext(filename):
+            return 1
+        try:
+            if os.path.lexists(filename):
+                os.remove(filename)
+            try:
+                os.link(source, filename)
+            except (OSError, AttributeError):
                 try:
-                    with open(filename, "wb") as f:
-                        cover_image.save(f)
+                    _reflink(source, filename)
                 except (OSError, IOError):
-                    print("Error opening target file " + filename)
-                    return 1
-            else:
-                print("Unsupported image file format '" + ext + "', use PNG")
-                return 1
+                    shutil.copyfile(source, filename)
+        except (OSError, IOError):
+            print("Error opening target file " + filename)
+            return 1
         return 0
 
     # Set up and parse the command line arguments passed to the program.
@@ -634,6 +848,9 @@ def main():
     parser.add_argument("-a", "--author", dest="author", help="Author(s) of the book")
     parser.add_argument("-o", "--cover", dest="outfile", help="Filename of the cover image in PNG format")
     parser.add_argument("-j", "--json-covers", dest="json_covers", help="JSON file containing cover information")
+    parser.add_argument("-p", "--profile", dest="profile", help="Profile the --json-covers run and write the samples to this file")
+    parser.add_argument("--profile-format", dest="profile_format", choices=("collapsed", "speedscope"),
+                        default="collapsed", help="Format of the --profile file (default: collapsed)")
     args = parser.parse_args()
 
     # A JSON file is given as command line parameter; ignore the other ones.
@@ -642,25 +859,77 @@ def main():
     #
     #   {"authors": "..", "identifier": "..", "subtitle": null, "title": "..",
     #    "identifier_type": "Gutenberg ID", "filename": ".."}
-    if args.json_covers:
+    #
+    # Records with identical draw() inputs (multi-volume sets, reprints, etc.)
+    # produce identical covers, so each unique cover is rendered only once and
+    # the resulting file is linked or copied to all other target filenames. If
+    # several records share a filename then, as before, the last one wins and
+    # the earlier ones are skipped.
+    if args.profile and not args.json_covers:
+        print("Profiling requires --json-covers, exiting")
+    elif args.json_covers:
+        profiler = None
         try:
+            if args.profile:
+                if not hasattr(signal, "setitimer"):
+                    print("Profiling is not supported on this platform, exiting")
+                    return 1
+                profiler = Profiler()
             with open(args.json_covers, "r") as f:
-                for line in f:
-                    data = json.loads(line)
-                    print("Generating cover for " + data["identifier"])
-                    status = _draw_and_save(
-                        data["title"],
-                        data["subtitle"],
-                        data["authors"],
-                        data["filename"]
-                    )
+                records = [json.loads(line) for line in f]
+            last = dict((data["filename"], i) for i, data in enumerate(records))
+            covers = collections.OrderedDict()
+            for i, data in enumerate(records):
+                if last[data["filename"]] != i:
+                    print("Skipping cover for " + data["identifier"] + ", " +
+                          data["filename"] + " is overwritten by a later record")
+                    continue
+                key = (data["title"], data["subtitle"], data["authors"])
+                covers.setdefault(key, []).append((data["identifier"], data["filename"]))
+            if profiler:
+                profiler.start()
+            nrenders = nwritten = nshared = 0
+            for (title, subtitle, author), targets in covers.items():
+                cover_image = None
+                source = None
+                for identifier, filename in targets:
+                    print("Generating cover for " + identifier)
+                    if source is not None:
+                        status = _link_or_copy(source, filename)
+                        nshared += not status
+                    else:
+                        if cover_image is None:
+                            cover_image = draw(title, subtitle, author)
+                            nrenders += 1
+                        status = _save(cover_image, filename)
+                        if not status:
+                            source = filename
                     if status:
                         print("Error generating book cover image, skipping")
+                    else:
+                        nwritten += 1
+            print("Rendered {0} covers for {1} records, saved {2} renders".format(
+                nrenders, nwritten, nshared
+            ))
+            if profiler:
+                profiler.stop()
+                try:
+                    with open(args.profile, "w") as f:
+                        if args.profile_format == "speedscope":
+                            profiler.write_speedscope(f)
+                        else:
+                            profiler.write_collapsed(f)
+                except (OSError, IOError):
+                    print("Error opening profile file " + args.profile)
+                    return 1
             return 0
         except ValueError:
             print("Error reading from JSON file, exiting")
         except (OSError, IOError):
             print("JSON cover file does not exist: " + args.json_covers)
+        finally:
+            if profiler:
+                profiler.stop()
 
     # Generate only a single cover based on the given command line arguments.
     else:
@@ -1,15 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import json
 import os
+import sys
 import unittest
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 import tenprintcover
 
 class TestMakeCovers(unittest.TestCase):
 
     def setUp(self):
         self.test_path =  os.path.join(os.path.dirname(__file__),'cover.png')
+        self.paths = []
 
     def test_cover(self):
         cover_image = tenprintcover.draw(
@@ -21,6 +29,156 @@ class TestMakeCovers(unittest.TestCase):
             cover_image.save(cover)
         self.assertTrue(os.path.exists(self.test_path))
 
+    def _path(self, name):
+        path = os.path.join(os.path.dirname(__file__), name)
+        self.paths.append(path)
+        return path
+
+    def _main(self, *args):
+        argv, stdout = sys.argv, sys.stdout
+        try:
+            sys.argv = ["tenprintcover.py"] + list(args)
+            sys.stdout = StringIO()
+            status = tenprintcover.main()
+            return status, sys.stdout.getvalue()
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+
+    def _write_json(self, *records):
+        json_path = self._path('covers.json')
+        with open(json_path, 'w') as covers:
+            for identifier, title, filename in records:
+                covers.write(json.dumps({
+                    "authors": "Donald Duck", "identifier": identifier,
+                    "subtitle": "", "title": title,
+                    "identifier_type": "Test ID", "filename": filename
+                }) + "\n")
+        return json_path
+
+    def _json_covers(self, *records):
+        return self._main("--json-covers", self._write_json(*records))
+
+    def test_json_covers_dedup(self):
+        copy_path = self._path('cover-copy.png')
+        draws = []
+        def counting_draw(*args):
+            draws.append(args)
+            return draw(*args)
+        draw = tenprintcover.draw
+        tenprintcover.draw = counting_draw
+        try:
+            status, output = self._json_covers(
+                ("1", "A truly amazing book", self.test_path),
+                ("2", "A truly amazing book", copy_path)
+            )
+        finally:
+            tenprintcover.draw = draw
+        self.assertEqual(status, 0)
+        self.assertEqual(len(draws), 1)
+        self.assertIn("Rendered 1 covers for 2 records, saved 1 renders", output)
+        with open(self.test_path, 'rb') as cover, open(copy_path, 'rb') as copy:
+            self.assertTrue(os.path.samefile(self.test_path, copy_path) or
+                            cover.read() == copy.read())
+
+    def test_json_covers_dedup_errors(self):
+        # Targets that cannot be written are not counted as saved renders.
+        status, output = self._json_covers(
+            ("1", "A truly amazing book", self._path('cover.jpg')),
+            ("2", "A truly amazing book", self._path('cover-copy.jpg'))
+        )
+        self.assertEqual(status, 0)
+        self.assertIn("Rendered 1 covers for 0 records, saved 0 renders", output)
+
+    def test_json_covers_reused_filename(self):
+        class TitleImage(object):
+            def __init__(self, title):
+                self.title = title
+            def save(self, f):
+                f.write(self.title.encode("utf-8"))
+        def read(path):
+            with open(path, 'rb') as cover:
+                return cover.read()
+        x_path, a_path = self._path('x.png'), self._path('a.png')
+        draw = tenprintcover.draw
+        tenprintcover.draw = lambda title, subtitle, author: TitleImage(title)
+        try:
+            # The last record for a filename wins, as if each was written in order.
+            status, output = self._json_covers(
+                ("1", "T1", x_path), ("2", "T2", a_path), ("3", "T1", a_path)
+            )
+            self.assertEqual(status, 0)
+            self.assertIn("Skipping cover for 2", output)
+            self.assertEqual(read(x_path), b"T1")
+            self.assertEqual(read(a_path), b"T1")
+            # Rewriting one of the (possibly linked) files leaves the other alone.
+            status, _ = self._json_covers(("4", "T3", x_path))
+            self.assertEqual(status, 0)
+            self.assertEqual(read(x_path), b"T3")
+            self.assertEqual(read(a_path), b"T1")
+        finally:
+            tenprintcover.draw = draw
+
+    def test_profiler(self):
+        profile_path = self._path('profile.txt')
+        profiler = tenprintcover.Profiler()
+        profiler._sample(None, sys._getframe())
+        profiler._sample(None, sys._getframe())
+        with open(profile_path, 'w') as profile:
+            profiler.write_collapsed(profile)
+        with open(profile_path, 'r') as profile:
+            lines = profile.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        stack, elapsed = lines[0].rsplit(" ", 1)
+        self.assertIn("TestMakeCovers.test_profiler", stack)
+        self.assertTrue(int(elapsed) >= 0)
+        with open(profile_path, 'w') as profile:
+            profiler.write_speedscope(profile)
+        with open(profile_path, 'r') as profile:
+            speedscope = json.load(profile)["profiles"][0]
+        self.assertEqual(speedscope["type"], "sampled")
+        self.assertEqual(speedscope["endValue"], sum(speedscope["weights"]))
+
+    def test_profiler_labels(self):
+        profile_path = self._path('profile.txt')
+        profiler = tenprintcover.Profiler()
+        # pylint: disable=unused-variable
+        def drawArtwork(c):
+            grid_count = 7
+            drawShape(c)
+        def drawShape(c):
+            chop("Supercalifragilistic")
+        def chop(word):
+            profiler._sample(None, sys._getframe())
+        for c in ("Q", ";"):
+            drawArtwork(c)
+        self.assertEqual(len(profiler.stacks), 2)
+        for stack in profiler.stacks:
+            labels = [label.split(" (")[0] for label in stack[-3:]]
+            self.assertIn(labels[1], ("drawShape 'Q'", "drawShape ';'"))
+            self.assertEqual([labels[0], labels[2]], ["drawArtwork 7x7", "chop 20 chars"])
+        # The semicolon glyph must not split its frame in the collapsed format.
+        with open(profile_path, 'w') as profile:
+            profiler.write_collapsed(profile)
+        with open(profile_path, 'r') as profile:
+            lines = profile.read().splitlines()
+        for line, stack in zip(lines, sorted(profiler.stacks)):
+            self.assertEqual(len(line.rsplit(" ", 1)[0].split(";")), len(stack))
+        self.assertTrue(any("drawShape 'U+003B'" in line for line in lines))
+
+    def test_profile_cli(self):
+        for profile_format in ("collapsed", "speedscope"):
+            profile_path = self._path('profile.' + profile_format)
+            json_path = self._write_json(("1", "A truly amazing book", self.test_path))
+            status, _ = self._main("--json-covers", json_path, "--profile", profile_path,
+                                   "--profile-format", profile_format)
+            self.assertEqual(status, 0)
+            self.assertTrue(os.path.exists(profile_path))
+        status, output = self._main("--title", "T", "--author", "A",
+                                    "--cover", self.test_path, "--profile", profile_path)
+        self.assertEqual(status, 1)
+        self.assertIn("Profiling requires --json-covers", output)
+
     def tearDown(self):
-        if os.path.exists(self.test_path):
-            os.remove(self.test_path)
+        for path in [self.test_path] + self.paths:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Golden image regression tests: render a fixed corpus of covers and compare
+# the pixel buffers against the hashes stored in golden_covers.json. The
+# artwork is drawn without anti-aliasing and must match exactly; the text is
+# anti-aliased and depends on the installed fonts, so it is compared as a
+# coarse grid of cell averages within a tolerance. Set the environment
+# variable TENPRINTCOVER_GOLDEN_EXACT=1 to require the whole image to match
+# exactly.
+#
+# Set TENPRINTCOVER_UPDATE_GOLDEN=1 to add the signatures of corpus cases that
+# are missing from the golden file. Existing signatures are never replaced, so
+# that the output of a changed render path cannot become its own reference;
+# after an intended change of the output, delete the affected entries (or the
+# whole file) first. Goldens must be generated from the unmodified draw() on
+# the reference setup with Cairo and the Noto fonts installed.
+#
+
+import hashlib
+import json
+import os
+import unittest
+
+import tenprintcover
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), 'golden_covers.json')
+
+# Size in pixels of the square cells of the text signature, and the maximum
+# difference of a cell's average byte value to its golden value.
+TEXT_CELL = 10
+TEXT_TOLERANCE = 16
+
+# All characters for which drawShape() draws a PETSCII shape.
+C64_LETTERS = " qQwWeErRtTyYuUiIoOpPaAsSdDfFgGhHjJkKlL:zZxXcCvVbBnNmM,;?<>@[]1234567890.=-+*/"
+
+# Title lengths for which breakGrid() returns the grid sizes 2x2 to 11x11.
+GRID_TITLE_LENGTHS = (2, 9, 15, 22, 28, 35, 41, 48, 54, 60)
+
+LONG_WORD = "Pneumonoultramicroscopicsilicovolcanoconiosis"
+
+# The corpus maps case names to the arguments of draw().
+CORPUS = dict(
+    [("grid-{0}".format(length), ((C64_LETTERS[1:] * 2)[:length], "", "Grid Author"))
+     for length in GRID_TITLE_LENGTHS] +
+    [
+        # The title cycles through all PETSCII shapes on an 11x11 grid.
+        ("petscii", (C64_LETTERS, "", "Shape Author")),
+        # Characters outside of the PETSCII range are mapped onto it.
+        ("petscii-mapped", (u"Ærøskøbing ÿ ß ñ ~ & # $ % _ |", "", "Mapped Author")),
+        ("cjk", (u"A truly amazing book", u"(但不是那么神奇)", u"唐老鸭和米老鼠")),
+        ("overflow-title", (" ".join(["Overflowing title words"] * 12), "", "Overflow Author")),
+        ("overflow-subtitle", ("Short", " ".join(["A subtitle that goes on"] * 10), "Overflow Author")),
+        ("overflow-author", ("Short", "", " and ".join(["Author Name"] * 10))),
+        # Image.text() calls chop() only if the first word of a text does not
+        # fit; a long word later on starts a new line and overflows unchopped.
+        ("chop-title", (LONG_WORD * 2, "", "Chop Author")),
+        ("overflow-long-word", ("A " + LONG_WORD * 2, "", "Overflow Author")),
+        ("chop-subtitle", ("Chop", LONG_WORD * 2, "Chop Author")),
+        ("chop-author", ("Chop", "", LONG_WORD * 2)),
+    ]
+)
+
+
+def _signature(cover_image):
+    """
+    Return the golden signature of the given Image: a hash of the whole image,
+    a hash of the artwork area, and the cell averages of the text area.
+    """
+    surface = cover_image.surface
+    surface.flush()
+    stride = surface.get_stride()
+    data = bytearray(surface.get_data()[:])
+    split = (cover_image.height - cover_image.width) * stride
+    cells = []
+    for cell_y in range(0, cover_image.height - cover_image.width, TEXT_CELL):
+        rows = range(cell_y, min(cell_y + TEXT_CELL, cover_image.height - cover_image.width))
+        for cell_x in range(0, cover_image.width, TEXT_CELL):
+            start = cell_x * 4
+            end = min(cell_x + TEXT_CELL, cover_image.width) * 4
+            total = sum(sum(data[row * stride + start:row * stride + end]) for row in rows)
+            cells.append(total // (len(rows) * (end - start)))
+    return {
+        "image": hashlib.sha1(data).hexdigest(),
+        "artwork": hashlib.sha1(data[split:]).hexdigest(),
+        "text": cells,
+    }
+
+
+class TestGoldenCovers(unittest.TestCase):
+
+    def test_golden_covers(self):
+        signatures = dict(
+            (name, _signature(tenprintcover.draw(*args))) for name, args in CORPUS.items()
+        )
+        if os.environ.get("TENPRINTCOVER_UPDATE_GOLDEN"):
+            goldens = {}
+            if os.path.exists(GOLDEN_PATH):
+                with open(GOLDEN_PATH, 'r') as golden:
+                    goldens = json.load(golden)
+            added = sorted(set(signatures) - set(goldens))
+            for name in added:
+                goldens[name] = signatures[name]
+            with open(GOLDEN_PATH, 'w') as golden:
+                json.dump(goldens, golden, indent=1, sort_keys=True)
+            self.skipTest("Added goldens to " + GOLDEN_PATH + ": " + (", ".join(added) or "none"))
+        self.assertTrue(os.path.exists(GOLDEN_PATH),
+                        "No golden file, run with TENPRINTCOVER_UPDATE_GOLDEN=1")
+        with open(GOLDEN_PATH, 'r') as golden:
+            goldens = json.load(golden)
+        exact = os.environ.get("TENPRINTCOVER_GOLDEN_EXACT")
+        failures = []
+        for name in sorted(CORPUS):
+            signature, golden = signatures[name], goldens.get(name)
+            if golden is None:
+                failures.append(name + ": missing golden")
+            elif exact and signature["image"] != golden["image"]:
+                failures.append(name + ": image differs")
+            elif signature["artwork"] != golden["artwork"]:
+                failures.append(name + ": artwork differs")
+            elif len(signature["text"]) != len(golden["text"]) or any(
+                    abs(a - b) > TEXT_TOLERANCE for a, b in zip(signature["text"], golden["text"])):
+                failures.append(name + ": text differs")
+        self.assertFalse(failures, "\n".join(failures))